@@ -9,9 +9,14 @@ Thread-based concurrency is used to speed-up the process
 
 import argparse
 import collections
+import email.message
+import email.utils
+import errno
+import io
 import logging
+import multiprocessing
 import os
-import shutil
+import re
 import sys
 import threading
 
@@ -20,110 +25,194 @@ from os import path
 
 import pathvalidate
 import requests
-import rfc6266
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 __version__ = '1.0'
 
+# read/write buffer size used when saving downloads to disk
+BUFFER_SIZE = 256 * 1024
+# number of hosts each session keeps connection pools for. Every worker thread has its own
+# session holding up to one idle socket per pool, so the default of 32 workers stays at
+# 640 open sockets, well below the common limit of 1024 open files.
+POOL_CONNECTIONS = 20
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 DownloadStats = collections.namedtuple('DownloadStats', 'success failed total')
 
+# media type and subtype of a content-type header
+_CONTENT_TYPE_RE = re.compile(r'\s*([^/;\s]+)/([^;\s]+)')
+
+# per-thread storage for requests sessions, see get_session()
+_thread_local = threading.local()
+
 
 def download_manager(url_file, out_dir='.', max_workers=None):
     """Concurrently download images listed in url_file to out_dir
 
     url_file can a filename or a file-like object
     max_workers limits the number of concurrent downloads
+    URLs are read lazily, downloads start while the rest of url_file is still being read.
     """
     if not hasattr(url_file, 'read'):
         url_file = open(url_file, 'r')
     if not path.isdir(out_dir):
         raise ValueError('Invalid output directory %r', out_dir)
 
-    # python2 back-port of concurrent.futures has no default max_workers
-    if sys.version_info.major < 3 and max_workers is None:
-        max_workers = 10
+    if max_workers is None:
+        # default of concurrent.futures in python 3.8, the python2 back-port has none
+        max_workers = min(32, multiprocessing.cpu_count() + 4)
 
-    error_count = 0
+    total = error_count = 0
+    pending = set()
     with url_file, futures.ThreadPoolExecutor(max_workers) as executor:
-        # read and queue downloads
-        urls = (line.strip() for line in url_file if line.strip())
-        fs = [executor.submit(download_image, url, out_dir) for url in urls]
+        # read and queue downloads, keeping at most 2 * max_workers in flight
+        for url in read_urls(url_file):
+            if len(pending) >= 2 * max_workers:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                error_count += _count_errors(done)
+            pending.add(executor.submit(download_image, url, out_dir))
+            total += 1
 
-        # log and count errors
-        for f in futures.as_completed(fs):
-            error = f.exception()
-            if error:
-                error_count += 1
-                logger.error(error)
+        error_count += _count_errors(futures.as_completed(pending))
 
-    return DownloadStats(success=len(fs) - error_count, failed=error_count, total=len(fs))
+    return DownloadStats(success=total - error_count, failed=error_count, total=total)
+
+
+def _count_errors(fs):
+    """Log and count the errors of completed futures"""
+    error_count = 0
+    for f in fs:
+        error = f.exception()
+        if error:
+            error_count += 1
+            logger.error(error)
+    return error_count
+
+
+def read_urls(url_file):
+    """Yield the URLs listed in url_file, skipping empty lines and duplicates"""
+    seen = set()
+    duplicates = 0
+    for line in url_file:
+        url = line.strip()
+        if not url:
+            continue
+        if url in seen:
+            duplicates += 1
+            continue
+        seen.add(url)
+        yield url
+
+    logger.debug('Skipped %d duplicate URLs', duplicates)
 
 
 def download_image(url, out_dir):
-    """Download a single image from url and save it to out_dir"""
+    """Download a single image from url and save it to out_dir
+
+    Only the response headers are fetched before the checks below. The
+    response is closed on failure, so rejected bodies are never downloaded.
+    """
     logger.debug('Requesting %r', url)
     response = get_session().get(url, stream=True)
-    response.raise_for_status()
+    try:
+        response.raise_for_status()
 
-    # check mime type
-    content_type = response.headers.get('content-type', '').split(';', 1)[0]
-    media_type, _, subtype = content_type.partition('/')
-    if media_type != 'image' or not subtype:
-        response.close()
-        raise ValueError('Invalid image type {!r} from {!r}'.format(content_type, url))
+        # check mime type
+        content_type = response.headers.get('content-type', '')
+        match = _CONTENT_TYPE_RE.match(content_type)
+        if not match or match.group(1).lower() != 'image':
+            raise ValueError('Invalid image type {!r} from {!r}'.format(content_type, url))
 
-    # read filename from content-disposition header
-    filename = get_filename(response, expected_extension=subtype)
-    filename = pathvalidate.sanitize_filename(filename, replacement_text='_')
-    file_path = rename_if_exists(file_path=path.join(out_dir, filename))
+        # read filename from content-disposition header
+        filename = get_filename(response, expected_extension=match.group(2).lower())
+        filename = pathvalidate.sanitize_filename(filename, replacement_text='_')
+        file_path, downloaded_file = create_unique_file(path.join(out_dir, filename))
 
-    # save to out_dir
-    with open(file_path, 'wb') as downloaded_file:
-        shutil.copyfileobj(response.raw, downloaded_file)
+        # save to out_dir
+        try:
+            with downloaded_file:
+                save_response(response, downloaded_file)
+        except Exception:
+            # don't leave partial downloads behind, but report the download error
+            try:
+                os.remove(file_path)
+            except OSError as error:
+                logger.debug('Failed to remove %r: %s', file_path, error)
+            raise
+    finally:
+        response.close()
 
     logger.debug('Saved %r', path.basename(file_path))
     return filename
 
 
+def save_response(response, downloaded_file):
+    """Write the (decoded) body of a streamed response to downloaded_file"""
+    for chunk in response.raw.stream(BUFFER_SIZE, decode_content=True):
+        downloaded_file.write(chunk)
+
+
 def get_filename(response, expected_extension):
-    """Get filename from content-disposition header"""
-    try:
-        content_disposition = rfc6266.parse_requests_response(response)
-    except Exception as error:  # lets not depend on the dependencies of rfc6266
-        logger.warning('Failed to parse content_disposition header from %r, error: %r',
-                       response.url, error)
-        # fall back on guessing the filename from the URL
-        basename = requests.utils.unquote_unreserved(response.url).rsplit('/', 1)[-1]
-        return (basename or 'file') + '.' + expected_extension
-
-    extension = content_disposition.filename_unsafe.rsplit('.', 1)[-1]
+    """Get filename from content-disposition header, fall back on the URL path"""
+    message = email.message.Message()
+    message['content-disposition'] = response.headers.get('content-disposition', '')
+    filename = None
+    for key, value in message.get_params([], header='content-disposition'):
+        # filename*= values (RFC 2231) are parsed into tuples, prefer them over filename=
+        if key == 'filename' and (filename is None or isinstance(value, tuple)):
+            filename = value
+    if filename is not None:
+        filename = email.utils.collapse_rfc2231_value(filename).strip()
+    if not filename:
+        filename = requests.compat.unquote(requests.compat.urlsplit(response.url).path)
+    # strip directories and leading dots
+    filename = filename.replace('\\', '/').rstrip('/').rsplit('/', 1)[-1].lstrip('.') or 'file'
+
+    extension = filename.rsplit('.', 1)[-1]
     # allow for some common file extension variations
-    safe_aliases = (extension.lower(),
-                    extension.lower().replace('jpeg', 'jpg'),
-                    extension.lower().replace('jpg', 'jpeg'))
+    extension_lower = extension.lower()
+    safe_aliases = {extension_lower}
+    if 'jpeg' in extension_lower:
+        safe_aliases.add(extension_lower.replace('jpeg', 'jpg'))
+    elif 'jpg' in extension_lower:
+        safe_aliases.add(extension_lower.replace('jpg', 'jpeg'))
     if expected_extension in safe_aliases:
         expected_extension = extension
 
-    return content_disposition.filename_sanitized(expected_extension)
+    if not filename.lower().endswith('.' + expected_extension.lower()):
+        filename += '.' + expected_extension
+    return filename
 
 
-def rename_if_exists(file_path):
-    """Appends a number (max 10000) to the filename if it already exists"""
-    if not path.exists(file_path):
-        return file_path
+def create_unique_file(file_path):
+    """Create and open a new file, appending a number (max 10000) to the filename if it exists
 
-    dirname = path.dirname(file_path)
-    basename, _, ext = path.basename(file_path).rpartition('.')
-    for i in range(1, 10000):
-        file_path = path.join(dirname, '{}_{}.{}'.format(basename, i, ext))
-        if not path.exists(file_path):
-            break
-    else:
-        logger.warning('Failed to rename %r', file_path)
+    Files are created exclusively, so concurrent downloads never pick the same name.
+    Returns the path of the created file and the file object opened for binary writing.
+    """
+    # split once, candidates only differ in the number
+    dirname, basename = path.split(file_path)
+    basename, dot, ext = basename.rpartition('.')
+    if not dot:
+        basename, ext = ext, ''
+    prefix, suffix = path.join(dirname, basename + '_'), dot + ext
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    for i in range(10000):
+        if i:
+            file_path = prefix + str(i) + suffix
+        try:
+            fd = os.open(file_path, flags, 0o644)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        else:
+            return file_path, io.open(fd, 'wb')
 
-    return file_path
+    raise OSError(errno.EEXIST, 'Failed to find a free filename', file_path)
 
 
 def get_session():
@@ -131,12 +220,24 @@ def get_session():
 
     Session instances are not thread-safe.
     See https://github.com/kennethreitz/requests/issues/2766
+    Reusing the session of the current thread keeps connections alive
+    between downloads from the same host.
     """
-    local = threading.local()
-    try:
-        session = local.session
-    except AttributeError:
-        session = local.session = requests.Session()
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = _thread_local.session = requests.Session()
+        session.headers.update({
+            'User-Agent': 'image-downloader/' + __version__,
+            'Accept': 'image/webp,image/*,*/*;q=0.8',
+        })
+        # retry connection errors and transient server errors with backoff
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        # keep pools for many hosts, so interleaved URLs don't evict each other
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=1,
+                              max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
 
     return session
 
@@ -168,14 +269,10 @@ def main(args=None):
             return -1
 
     stats = download_manager(options.filename, options.out_dir, options.max_workers)
-    logger.info('Downloaded %d files, %d failed (%s entries in file)', *stats)
+    logger.info('Downloaded %d files, %d failed (%s unique URLs in file)', *stats)
 
 
 if __name__ == '__main__':
-    # fix default logging in rfc6266 package
-    rfc6266.LOGGER.removeHandler(logging.NullHandler)  # yes, the class
-    rfc6266.LOGGER.addHandler(logging.NullHandler())
-
     handler = logging.StreamHandler(sys.stdout)
     handler.setFormatter(logging.Formatter('{levelname:7} {message}', style='{'))
     logger.addHandler(handler)
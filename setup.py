@@ -2,7 +2,6 @@ from setuptools import setup
 
 install_requires = [
     'requests >= 2.13',
-    'rfc6266 >= 0.0.4',
     'pathvalidate >= 0.14',
     'futures>=3.0; python_version <= "3"',
 ]
@@ -1,5 +1,7 @@
 """Tests for image_downloader.py"""
 import io
+import time
+import zlib
 
 import pytest
 import requests
@@ -14,6 +16,7 @@ import image_downloader
     ('foobar.jpg', 'image/jpeg', 'foobar.jpg'),
     ('foobar.jpeg', 'image/jpg', 'foobar.jpeg'),
     ('foobar.jpg', 'image/bmp', 'foobar.jpg.bmp'),
+    ('foobar.png', 'Image/PNG; charset=binary', 'foobar.png'),
 ])
 @responses.activate
 def test_download_image(resource_name, content_type, expected_filename, tmpdir):
@@ -47,16 +50,27 @@ def test_wrong_content_type(tmpdir):
     excinfo.match('Invalid image type')
 
 
-def test_rename_if_exists(tmpdir):
+def test_create_unique_file(tmpdir):
     file_path = tmpdir.join('test.jpg')
     file_path_1 = tmpdir.join('test_1.jpg')
     file_path_2 = tmpdir.join('test_2.jpg')
 
-    assert file_path == image_downloader.rename_if_exists(str(file_path))
-    file_path.open('w').close()
-    assert file_path_1 == image_downloader.rename_if_exists(str(file_path))
-    file_path_1.open('w').close()
-    assert file_path_2 == image_downloader.rename_if_exists(str(file_path))
+    for expected_path in (file_path, file_path_1, file_path_2):
+        created_path, created_file = image_downloader.create_unique_file(str(file_path))
+        created_file.close()
+        assert expected_path == created_path
+        assert expected_path.exists()
+
+
+def test_create_unique_file_without_extension(tmpdir):
+    out_dir = tmpdir.mkdir('out.v2')
+    file_path = out_dir.join('test')
+
+    for expected_path in (file_path, out_dir.join('test_1'), out_dir.join('test_2')):
+        created_path, created_file = image_downloader.create_unique_file(str(file_path))
+        created_file.close()
+        assert expected_path == created_path
+        assert expected_path.exists()
 
 
 def test_download_manager(monkeypatch, tmpdir):
@@ -68,14 +82,190 @@ def test_download_manager(monkeypatch, tmpdir):
     monkeypatch.setattr(image_downloader, 'download_image', download_image_mock)
 
     url_list = u"""
-        success
-        success
+        success1
+        success2
 
-        raise
-        raise
-        success
+        raise1
+        raise2
+        success3
     """
     stats = image_downloader.download_manager(io.StringIO(url_list), str(tmpdir), max_workers=2)
     assert stats.failed == url_list.count('raise')
     assert stats.success == url_list.count('success')
     assert stats.total == 5
+
+
+def test_download_manager_bounds_pending(monkeypatch, tmpdir):
+    """at most 2 * max_workers downloads are queued at any time"""
+    max_workers = 2
+    finished = []
+    in_flight = []
+
+    class CountingStringIO(io.StringIO):
+        lines_read = 0
+
+        def readline(self, *args):
+            # all URLs of previous lines have been submitted by now
+            in_flight.append(self.lines_read - len(finished))
+            self.lines_read += 1
+            return super(CountingStringIO, self).readline(*args)
+
+    def download_image_mock(url, out_dir):
+        time.sleep(0.001)
+        finished.append(url)
+    monkeypatch.setattr(image_downloader, 'download_image', download_image_mock)
+
+    url_file = CountingStringIO(u'\n'.join('url{}'.format(i) for i in range(100)))
+    stats = image_downloader.download_manager(url_file, str(tmpdir), max_workers)
+    assert stats.total == 100
+    assert max(in_flight) <= 2 * max_workers
+
+
+def test_read_urls_skips_duplicates():
+    url_list = u"""
+        http://abc.de/1.jpg
+        http://abc.de/2.jpg
+
+        http://abc.de/1.jpg
+        http://abc.de/3.jpg
+        http://abc.de/2.jpg
+    """
+    urls = list(image_downloader.read_urls(io.StringIO(url_list)))
+    assert urls == ['http://abc.de/1.jpg', 'http://abc.de/2.jpg', 'http://abc.de/3.jpg']
+
+
+def test_get_session_is_reused():
+    assert image_downloader.get_session() is image_downloader.get_session()
+
+
+@responses.activate
+def test_fail404_closes_response(monkeypatch, tmpdir):
+    url = 'http://abc.de/bla/foobar.jpg'
+    responses.add(responses.GET, url, status=404, content_type='text/plain')
+    closed = []
+    monkeypatch.setattr(requests.Response, 'close', lambda self: closed.append(self))
+    with pytest.raises(requests.exceptions.HTTPError):
+        image_downloader.download_image(url, str(tmpdir))
+    assert closed
+
+
+@responses.activate
+def test_download_image_content(monkeypatch, tmpdir):
+    monkeypatch.setattr(image_downloader, 'BUFFER_SIZE', 4)
+    url = 'http://abc.de/bla/foobar.png'
+    body = b'0123456789' * 3
+    responses.add(responses.GET, url, body=body, content_type='image/png')
+    image_downloader.download_image(url, str(tmpdir))
+    downloaded_file, = tmpdir.listdir()
+    assert downloaded_file.read_binary() == body
+
+
+@pytest.mark.parametrize('content_encoding,encode', [
+    (None, lambda body: body),
+    ('deflate', zlib.compress),
+])
+@pytest.mark.parametrize('buffer_size', [4, 64, 256 * 1024])
+@responses.activate
+def test_download_image_decodes_content(content_encoding, encode, buffer_size, monkeypatch,
+                                        tmpdir):
+    monkeypatch.setattr(image_downloader, 'BUFFER_SIZE', buffer_size)
+    url = 'http://abc.de/bla/foobar.png'
+    # compresses well: decoded reads return more (or nothing) for a small compressed read
+    body = b'0123456789' * 100000
+    headers = {'Content-Encoding': content_encoding} if content_encoding else {}
+    responses.add(responses.GET, url, body=encode(body), content_type='image/png',
+                  headers=headers)
+    image_downloader.download_image(url, str(tmpdir))
+    downloaded_file, = tmpdir.listdir()
+    assert downloaded_file.read_binary() == body
+
+
+@pytest.mark.parametrize('content_disposition,expected_filename', [
+    ('attachment; filename="holiday.jpg"', 'holiday.jpg'),
+    ('attachment; filename="../../holiday.jpg"', 'holiday.jpg'),
+    ("attachment; filename*=UTF-8''f%C3%BC%C3%9Fe.png", u'f\xfc\xdfe.png.jpeg'),
+    ('attachment; filename="fallback.jpg"; filename*=UTF-8\'\'%C3%BCber.jpg', u'\xfcber.jpg'),
+    ('attachment; filename*=UTF-8\'\'%C3%BCber.jpg; filename="fallback.jpg"', u'\xfcber.jpg'),
+    ('inline', 'foobar.jpg'),
+])
+@responses.activate
+def test_get_filename_content_disposition(content_disposition, expected_filename):
+    url = 'http://abc.de/bla/foobar.jpg'
+    responses.add(responses.GET, url, content_type='image/jpeg',
+                  headers={'Content-Disposition': content_disposition})
+    response = requests.get(url, stream=True)
+    assert image_downloader.get_filename(response, 'jpeg') == expected_filename
+
+
+@responses.activate
+def test_download_image_removes_partial_file(monkeypatch, tmpdir):
+    def stream_mock(self, *args, **kwargs):
+        yield b'01234'
+        raise requests.exceptions.ConnectionError('connection reset')
+    monkeypatch.setattr(requests.packages.urllib3.response.HTTPResponse, 'stream', stream_mock)
+    url = 'http://abc.de/bla/foobar.png'
+    responses.add(responses.GET, url, body=b'0123456789', content_type='image/png')
+    with pytest.raises(requests.exceptions.ConnectionError):
+        image_downloader.download_image(url, str(tmpdir))
+    assert tmpdir.listdir() == []
+
+
+@responses.activate
+def test_download_image_reports_error_if_remove_fails(monkeypatch, tmpdir):
+    def stream_mock(self, *args, **kwargs):
+        raise requests.exceptions.ConnectionError('connection reset')
+        yield
+    monkeypatch.setattr(requests.packages.urllib3.response.HTTPResponse, 'stream', stream_mock)
+
+    def remove_mock(file_path):
+        raise OSError('permission denied')
+    monkeypatch.setattr(image_downloader.os, 'remove', remove_mock)
+    url = 'http://abc.de/bla/foobar.png'
+    responses.add(responses.GET, url, body=b'0123456789', content_type='image/png')
+    with pytest.raises(requests.exceptions.ConnectionError):
+        image_downloader.download_image(url, str(tmpdir))
+
+
+@pytest.mark.parametrize('content_type', ['image', 'image/', 'text/html; charset=utf-8', ''])
+@responses.activate
+def test_invalid_content_type(content_type, tmpdir):
+    url = 'http://abc.de/bla/foobar.jpg'
+    responses.add(responses.GET, url, body='', headers={'Content-Type': content_type})
+    with pytest.raises(ValueError) as excinfo:
+        image_downloader.download_image(url, str(tmpdir))
+    excinfo.match('Invalid image type')
+
+
+@responses.activate
+def test_download_image_retries_server_error(tmpdir):
+    url = 'http://abc.de/bla/foobar.png'
+    responses.add(responses.GET, url, status=503)
+    responses.add(responses.GET, url, body=b'0123456789', content_type='image/png')
+    image_downloader.download_image(url, str(tmpdir))
+    assert len(responses.calls) == 2
+    downloaded_file, = tmpdir.listdir()
+    assert downloaded_file.read_binary() == b'0123456789'
+
+
+def test_download_manager_reads_lazily(monkeypatch, tmpdir):
+    """downloads start before the whole url file is read"""
+    class CountingStringIO(io.StringIO):
+        lines_read = 0
+
+        def readline(self, *args):
+            self.lines_read += 1
+            return super(CountingStringIO, self).readline(*args)
+
+    def download_image_mock(url, out_dir):
+        lines_read.append(url_file.lines_read)
+        time.sleep(0.001)
+    monkeypatch.setattr(image_downloader, 'download_image', download_image_mock)
+
+    max_workers = 1
+    url_file = CountingStringIO(u'\n'.join('url{}'.format(i) for i in range(100)))
+    lines_read = []
+    stats = image_downloader.download_manager(url_file, str(tmpdir), max_workers)
+    assert stats.total == 100
+    # read-ahead is bounded by the queued downloads
+    for i, read in enumerate(lines_read):
+        assert read <= i + 2 * max_workers + 1